@@ -15,144 +15,173 @@ Jonte Dancker
 import os
 import warnings
 
-import bibtexparser
 import numpy as np
 import pandas as pd
-from bibtexparser.bibdatabase import as_text
-from bibtexparser.bparser import BibTexParser
-from bibtexparser.customization import homogenize_latex_encoding
-from d3graph import d3graph, vec2adjmat
-
-from utils import access_API, add_literature, get_literature_keys
+from d3graph import d3graph
+from scipy.sparse import coo_matrix
+
+from utils import (
+    MEMBER_DTYPE,
+    add_literature,
+    add_paper,
+    fetch_all,
+    get_bibtex_dois,
+    get_literature_details,
+    get_literature_keys,
+)
 
 # %% General parameters
 bibliography_source = "literature.bib"
 cleaning_quantile = 0.99
 recommendation_quantile = 0.9
+download_concurrency = 8
+download_cache = ".semantic_scholar_cache.sqlite"
 
 save_filename = "dependency"
 save_overwrite = True
 
 
 # %% Import data from bib-file
+# only the DOIs of the papers are needed, so the bib-file is only scanned for its
+# entries and DOI fields
 with open(bibliography_source) as bibtex_file:
-    parser = BibTexParser()
-    parser.customization = homogenize_latex_encoding
-    bib_database = bibtexparser.load(bibtex_file, parser=parser)
-
-# relationship / connections between papers
-relationships = pd.DataFrame({"from": [], "to": []})
-# paper information
-all_papers = pd.DataFrame(
-    {
-        "paperID": [],
-        "authors": [],
-        "year": [],
-        "doi": [],
-        "title": [],
-        "occurence": [],
-    }
-)
+    number_of_entries, bibtex_DOIs = get_bibtex_dois(bibtex_file.read())
+
+# relationship / connections between papers as (from, to) pairs of paper codes, only
+# the first number_of_relationships rows are used
+relation_array = np.empty((1024, 2), dtype=np.int32)
+number_of_relationships = 0
+# paper information indexed by paperID
+paper_index = {}
+# codes of the papers which are part of the bibtex-file
+owned_codes = []
 
 # %% Add Literature Data
 
-counter_connected_papers = 1
-# Save author, year, title and doi in dict-variable
-for entries in bib_database.entries:
+# get DOIs of all papers in the bibtex-file which have one, every DOI only once
+DOIs = []
+seen_DOIs = set()
+for DOI in bibtex_DOIs:
 
-    if "doi" not in entries:  # IF entry does not have DOI
+    # DOIs are case insensitive
+    if DOI.lower() in seen_DOIs:  # IF paper is part of the bibtex-file twice
         continue
+    seen_DOIs.add(DOI.lower())
+    DOIs.append(DOI)
 
-    # get DOI from Literature
-    DOI = as_text(entries["doi"])
-
-    # get json-file of literature via DOI
-    resp = access_API("https://api.semanticscholar.org/v1/paper/" + DOI)
+# get json-files of all literature via DOI
+print(f"Downloading {len(DOIs)} papers from semantic scholar")
+papers = fetch_all(DOIs, concurrency=download_concurrency, cache_file=download_cache)
 
-    # If user wants to exit after server is not allowing download break
-    # whole download loop
-    if resp is None:
-        break
+counter_connected_papers = 1
+# Count occurences of all papers and save their connections
+for paper in papers:
 
-    # If something else went wrong.
-    if resp.status_code != 200:
+    # If something went wrong.
+    if paper is None:
         continue
 
     # giving user status feedback
-    print(f"Paper {counter_connected_papers} of {len(bib_database.entries)}")
+    print(f"Paper {counter_connected_papers} of {number_of_entries}")
 
     # another paper is added
     counter_connected_papers += 1
 
     # get keys of current paper available in bibtex-file
-    availablePaper = get_literature_keys(resp.json(), "owned")
+    availablePaper = get_literature_keys(paper, "owned")
 
     # add available paper to all papers
-    if any(
-        all_papers["paperID"].isin(availablePaper["paperID"])
-    ):  # IF available paper is already saved
-        # count occurence of paper up by 1
-        all_papers.loc[
-            all_papers["paperID"] == availablePaper.loc[0, "paperID"], "occurence"
-        ] += 1
-        # change membership to owned
-        all_papers.loc[
-            all_papers["paperID"] == availablePaper.loc[0, "paperID"], "member"
-        ] = "owned"
-    else:
-        # add available paper to all papers
-        all_papers = pd.concat([all_papers, availablePaper], ignore_index=True)
-
-    # loop through referenced literature and get key values
-    for ref in range(len(resp.json()["references"])):
-        referencedPaper = get_literature_keys(resp.json()["references"][ref], "new")
-        all_papers, relationships = add_literature(
-            all_papers, relationships, availablePaper, referencedPaper
-        )
+    paperCode = add_paper(paper_index, availablePaper)
+    owned_codes.append(paperCode)
+    # change membership to owned, in case paper was already saved as new paper
+    paper_index[availablePaper["paperID"]]["member"] = "owned"
+
+    # get key values of referenced literature
+    referencedPapers = [
+        get_literature_keys(ref, "new") for ref in paper.get("references", [])
+    ]
+    relation_array, number_of_relationships = add_literature(
+        paper_index,
+        relation_array,
+        number_of_relationships,
+        paperCode,
+        referencedPapers,
+    )
 
-    # loop through cited literature and get key values
-    citedLiterature = pd.DataFrame({})
-    for ref in range(len(resp.json()["citations"])):
-        cited_papers = get_literature_keys(resp.json()["citations"][ref], "new")
-        all_papers, relationships = add_literature(
-            all_papers, relationships, availablePaper, cited_papers
-        )
+    # get key values of cited literature
+    cited_papers = [
+        get_literature_keys(cit, "new") for cit in paper.get("citations", [])
+    ]
+    relation_array, number_of_relationships = add_literature(
+        paper_index, relation_array, number_of_relationships, paperCode, cited_papers
+    )
+
+# build data frames once after all papers were collected
+all_papers = pd.DataFrame.from_records(
+    list(paper_index.values()),
+    columns=["paperID", "member"],
+)
+all_papers["member"] = all_papers["member"].astype(MEMBER_DTYPE)
+# papers are identified in relationships by their code, which is their index in
+# all_papers
+relationships = pd.DataFrame(
+    relation_array[:number_of_relationships], columns=["from", "to"]
+)
+
+# a paper occurs each time it is part of the bibtex-file, referenced or cited
+all_papers["occurence"] = np.bincount(
+    relationships["to"], minlength=len(all_papers)
+) + np.bincount(owned_codes, minlength=len(all_papers))
 
 
 # %% Clean Data by deleting uninteresting papers (less often cited/ referenced papers)
 number_of_extracter_papers = len(all_papers)
 # delete all new papers with a number of occurence that lie below a quantile threshold
-idx_delete_papers = all_papers.index[
-    (all_papers["occurence"] <= all_papers["occurence"].quantile(cleaning_quantile))
-    & (all_papers["member"] == "new")
-]
-all_papers.drop(idx_delete_papers, inplace=True)
+cleaning_threshold = np.quantile(all_papers["occurence"].to_numpy(), cleaning_quantile)
+keep_papers = (all_papers["occurence"] > cleaning_threshold) | (
+    all_papers["member"] != "new"
+)
+kept_codes = all_papers.index[keep_papers]
 
 # delete connections in graph
-idx_delete_papers = np.flatnonzero(
-    ~relationships["from"].isin(all_papers["paperID"])
-    | ~relationships["to"].isin(all_papers["paperID"])
-)
+idx_delete_papers = relationships.index[
+    ~(relationships["from"].isin(kept_codes) & relationships["to"].isin(kept_codes))
+]
 relationships.drop(idx_delete_papers, inplace=True)
 
 # remove paper without connections
+connected_codes = np.unique(
+    np.concatenate([relationships["from"].to_numpy(), relationships["to"].to_numpy()])
+)
 idx_delete_papers = all_papers.index[
-    ~all_papers["paperID"].isin(relationships["from"])
-    & ~all_papers["paperID"].isin(relationships["to"])
+    ~keep_papers | ~all_papers.index.isin(connected_codes)
 ]
 all_papers.drop(idx_delete_papers, inplace=True)
 
+# get authors, year, DOI and title of the remaining papers
+paper_details = pd.DataFrame.from_records(
+    [
+        get_literature_details(paper_index[paperID]["literature"])
+        for paperID in all_papers["paperID"]
+    ],
+    index=all_papers.index,
+    columns=["authors", "year", "doi", "title"],
+)
+all_papers = all_papers.join(paper_details)
+# keep years as integers although some papers have no year
+all_papers["year"] = all_papers["year"].astype("Int64")
+
 
 # %% identify new papers of possible interest
 # interesting papers are identified by their number of occurences. The more often a
 # paper is cited the better is must be and the higher its impact on the field can be
 # assumed.
 # change membership to recommended
+recommendation_threshold = np.quantile(
+    all_papers["occurence"].to_numpy(), recommendation_quantile
+)
 all_papers.loc[
-    (
-        all_papers["occurence"]
-        >= all_papers["occurence"].quantile(recommendation_quantile)
-    )
+    (all_papers["occurence"] >= recommendation_threshold)
     & (all_papers["member"] == "new"),
     "member",
 ] = "recommended"
@@ -160,7 +189,7 @@ all_papers.loc[
 
 # %% User feedback
 print(
-    f"{counter_connected_papers} of {len(bib_database.entries)}"
+    f"{counter_connected_papers} of {number_of_entries}"
     "papers from bibtex-file were added to graph. \n"
 )
 print(
@@ -190,45 +219,55 @@ else:
     )
 
 # %% PLOTTING
-# Create adjacency matrix
-adjmat = vec2adjmat(
-    relationships["from"], relationships["to"], weight=np.ones(len(relationships))
+# Create adjacency matrix with the nodes in the same order as all_papers, so that node
+# colors, sizes, labels and tooltips belong to the right node. The matrix is built
+# as sparse matrix instead of by pd.crosstab, but d3graph converts it into a dense
+# matrix internally, so this does not reduce the memory needed for plotting.
+adjmat = coo_matrix(
+    (
+        np.ones(len(relationships)),
+        (
+            all_papers.index.get_indexer(relationships["from"]),
+            all_papers.index.get_indexer(relationships["to"]),
+        ),
+    ),
+    shape=(len(all_papers), len(all_papers)),
+)
+adjmat = pd.DataFrame.sparse.from_spmatrix(
+    adjmat, index=all_papers["paperID"], columns=all_papers["paperID"]
 )
 
-# assign colors to nodes
-colors = ["#a9a9a9", "#1e90ff", "#ff8c00"]  # ["darkgray", "dodgerblue", "darkorange"]
-condition = [(all_papers["member"] == "owned"), (all_papers["member"] == "recommended")]
-node_colors = np.select(condition, colors[1:], default=colors[0])
+# assign colors to nodes, ordered like the membership categories of MEMBER_DTYPE
+colors = np.array(["#1e90ff", "#a9a9a9", "#ff8c00"])  # dodgerblue, darkgray, darkorange
+node_colors = colors[all_papers["member"].cat.codes.to_numpy()]
 
 # Set node size by number of occurences in a variable manner so that paper with maximum
 # number of occurence has always the same size independently of its number of occurence
 maxValue = all_papers["occurence"].max()
 minValue = all_papers["occurence"].min()
 sizingFactor = 100 / (maxValue - minValue)
-nodeSize = np.ceil(
-    (all_papers["occurence"].values - minValue) * sizingFactor + 1
-).tolist()
+nodeSize = np.ceil((all_papers["occurence"].to_numpy() - minValue) * sizingFactor + 1)
 
 # label papers by name of first author and year of publication
 all_papers.loc[all_papers["authors"] == "", "authors"] = "X X"
-all_papers["year"].fillna(0, inplace=True)
-nodel_labels = [
-    " ".join([author.split()[1], str(int(year))])
-    for author, year in zip(all_papers["authors"], all_papers["year"])
-]
+year_str = all_papers["year"].fillna(0).astype(np.int64).astype(str)
+nodel_labels = all_papers["authors"].str.split().str[1].fillna("X") + " " + year_str
 
 # information of pop up window for each paper
-tooltip = (
-    "Authors: "
-    + all_papers["authors"]
-    + "\nYear: "
-    + all_papers["year"].astype(int).astype(str)
-    + "\nTitle: "
-    + all_papers["title"]
-    + "\nOccurences: "
-    + all_papers["occurence"].astype(int).astype(str)
+tooltip = np.fromiter(
+    (
+        f"Authors: {authors}\nYear: {year}\nTitle: {title}\n"
+        f"Occurences: {int(occurence)}"
+        for authors, year, title, occurence in zip(
+            all_papers["authors"].to_numpy(),
+            year_str.to_numpy(),
+            all_papers["title"].to_numpy(),
+            all_papers["occurence"].to_numpy(),
+        )
+    ),
+    dtype=object,
+    count=len(all_papers),
 )
-tooltip = tooltip.values
 
 # Initialize and build force-directed graph
 d3 = d3graph(charge=300)
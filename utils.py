@@ -1,12 +1,121 @@
 """Utility functions for the scientific-paper-dependencies project."""
+import re
+import sqlite3
 import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
 
+import numpy as np
+import orjson
 import pandas as pd
 import requests
 
+# membership of a paper, see `get_literature_keys`
+MEMBER_DTYPE = pd.CategoricalDtype(["owned", "new", "recommended"], ordered=False)
+
+# start of an entry in a bibtex-file, e.g. "@article{"
+BIBTEX_ENTRY = re.compile(r"@\s*(\w+)\s*([{(])")
+
+SEMANTIC_SCHOLAR_URL = "https://api.semanticscholar.org/v1/paper/"
+# cached papers are downloaded again after 30 days
+CACHE_EXPIRE = 30 * 24 * 60 * 60
+
+
+def get_bibtex_dois(bibtex):
+    """Scan the content of a bibtex-file for its entries and their DOIs.
+
+    Only the DOIs of the papers are needed, so the bibtex-file is not parsed
+    completely. Instead, every entry is split into its fields, taking nested braces
+    into account, and only the `doi` field is read. @comment, @preamble and @string
+    blocks are skipped.
+
+    Parameters
+    ----------
+    bibtex : str
+        content of the bibtex-file
+
+    Returns
+    -------
+    number_of_entries : int
+        number of entries in the bibtex-file
+    dois : list
+        contains the DOIs of all entries which have one, in the order of the file
+
+    """
+    number_of_entries = 0
+    dois = []
+    position = 0
+    while True:
+        start = BIBTEX_ENTRY.search(bibtex, position)
+        if start is None:
+            break
+
+        # find end of entry at closing brace or parenthesis of the same depth
+        closing = "}" if start.group(2) == "{" else ")"
+        depth = 0
+        end = start.end()
+        while end < len(bibtex):
+            if bibtex[end] == "{":
+                depth += 1
+            elif bibtex[end] == "}" and depth > 0:
+                depth -= 1
+            elif bibtex[end] == closing and depth == 0:
+                break
+            end += 1
+        else:
+            warnings.warn(
+                f"Entry at position {start.start()} of bibtex-file is not closed."
+            )
+            break
+        position = end + 1
+
+        if start.group(1).lower() in ("comment", "preamble", "string"):
+            continue
+        number_of_entries += 1
+
+        # split entry into key and fields at commas outside of braces and quotes
+        fields = []
+        field_start = start.end()
+        depth = 0
+        quoted = False
+        for idx in range(start.end(), end):
+            if bibtex[idx] == "{":
+                depth += 1
+            elif bibtex[idx] == "}":
+                depth -= 1
+            elif bibtex[idx] == '"' and depth == 0:
+                quoted = not quoted
+            elif bibtex[idx] == "," and depth == 0 and not quoted:
+                fields.append(bibtex[field_start:idx])
+                field_start = idx + 1
+        fields.append(bibtex[field_start:end])
+
+        # get DOI from fields
+        for field in fields[1:]:
+            name, _, value = field.partition("=")
+            if name.strip().lower() != "doi":
+                continue
+            doi = value.strip()
+            if len(doi) > 1 and doi[0] == doi[-1] == '"':
+                doi = doi[1:-1]
+            doi = doi.replace("{", "").replace("}", "").strip()
+            if doi:
+                dois.append(doi)
+            else:
+                warnings.warn(
+                    f"DOI of entry {fields[0].strip()} could not be read: {value}"
+                )
+
+    return number_of_entries, dois
+
 
 def get_literature_keys(literature, member):
-    """Extract needed key values from literature data.
+    """Extract key values needed for connecting a paper to other papers.
+
+    Only the paperID and the membership are extracted. The remaining information about
+    the paper is extracted later by `get_literature_details`, only for papers which are
+    kept in the graph.
 
     Parameters
     ----------
@@ -19,82 +128,121 @@ def get_literature_keys(literature, member):
 
     Returns
     -------
-    data : pd.dataframe
-        contains needed key values of the paper
+    data : dict
+        contains needed key values of the paper and the `literature` itself
 
     """
-    data = pd.DataFrame(
-        {
-            "paperID": literature["paperId"],
-            "authors": ", ".join([author["name"] for author in literature["authors"]]),
-            "year": literature["year"],
-            "doi": literature["doi"],
-            "title": literature["title"],
-            "occurence": 1,
-        },
-        index=[0],
-    )
-
-    # add category to paper
-    raw_cat = pd.Categorical(
-        member, categories=["owned", "new", "recommended"], ordered=False
-    )
-    data["member"] = raw_cat
+    data = {
+        "paperID": literature["paperId"],
+        "member": member,
+        "literature": literature,
+    }
 
     return data
 
 
-def add_literature(all_papers, relationships, current_paper, newPaper):
-    """Add new literature data and relationship to existing literature data.
+def get_literature_details(literature):
+    """Extract authors, year, DOI and title from literature data.
+
+    Parameters
+    ----------
+    literature : dict
+        contains all information about a paper extracted for semantic scholar.
+
+    Returns
+    -------
+    data : dict
+        contains authors, year, DOI and title of the paper
+
+    """
+    data = {
+        "authors": ", ".join([author["name"] for author in literature["authors"]]),
+        "year": literature["year"],
+        "doi": literature["doi"],
+        "title": literature["title"],
+    }
+
+    return data
+
+
+def add_paper(paper_index, newPaper):
+    """Add a new paper to the existing papers and return its code.
+
+    The code of a paper is the integer position at which it was added to
+    `paper_index`. If the new paper is already part of `paper_index` the paper is not
+    added again and the code of the existing paper is returned.
+
+    Parameters
+    ----------
+    paper_index : dict
+        maps the paperID of all papers which were either part of the bibtex-file or
+        were already downloaded from semanitc scholar to their key values, including
+        paperID, code and membership
+    newPaper : dict
+        contains key values of the paper to add
+
+    Returns
+    -------
+    code : int
+        code of the paper
+
+    """
+    if newPaper["paperID"] not in paper_index:  # IF paper is not saved yet
+        newPaper["code"] = len(paper_index)
+        paper_index[newPaper["paperID"]] = newPaper
+
+    return paper_index[newPaper["paperID"]]["code"]
+
+
+def add_literature(
+    paper_index, relationships, number_of_relationships, current_code, newPapers
+):
+    """Add new literature data and relationships to existing literature data.
 
     This function adds new papers to the existing, already saved, papers and also adds
-    the relationsship between new papers and the paper extracted from the bibtex-file.
-    If the new paper is already part of `all_papers` the paper is not added but its
-    occurence is counted up by 1.
+    the relationsships between new papers and the paper extracted from the bibtex-file.
+    If a new paper is already part of `paper_index` only the relationship is added.
+    The relationships are written into a preallocated array, which is doubled in size
+    whenever it is full.
 
     Parameters
     ----------
-    all_papers : pd.dataframe
-        contains information about all papers which were either part of the bibtex-file
-        or were already downloaded from semanitc scholar, including paperID, authors,
-        DOI, title, number of occurences
-    relationships : pd.dataframe
-        contains information on how the papers in `all_papers` are related to each other
-    current_paper : pd.dataframe
-        contains information about the current paper from the bibtex-file
-    newPaper : pd.dataframe
-        contains information about the paper which is related to `current_paper`
+    paper_index : dict
+        maps the paperID of all papers which were either part of the bibtex-file or
+        were already downloaded from semanitc scholar to their key values, including
+        paperID, code and membership. It is updated in place.
+    relationships : np.ndarray
+        int32 array of shape (n, 2) containing (from, to) pairs of paper codes
+        describing how the papers in `paper_index` are related to each other. Only
+        the first `number_of_relationships` rows are used.
+    number_of_relationships : int
+        number of relationships already saved in `relationships`
+    current_code : int
+        code of the current paper from the bibtex-file
+    newPapers : list
+        contains the key values of the papers which are related to `current_code`
 
     Returns
     -------
-     all_papers : pd.dataframe
-        contains updated information about all papers. The return value contains the
-        additional information of `newPaper`
-    relationships : pd.dataframe
-        contains updated information on how the papers in `all_papers` are related to
-        each other including the additional information of `newPaper`
+    relationships : np.ndarray
+        contains updated relationships including the relationships to `newPapers`
+    number_of_relationships : int
+        updated number of relationships saved in `relationships`
 
     """
-    # add relationship between available and referenced paper
-    relation = {
-        "from": current_paper.loc[0, "paperID"],
-        "to": newPaper.loc[0, "paperID"],
-    }
-    relationships = relationships.append(relation, ignore_index=True)
+    # add new papers to all papers
+    codes = [add_paper(paper_index, newPaper) for newPaper in newPapers]
 
-    # add referenced paper to all papers
-    if any(
-        all_papers["paperID"].isin(newPaper["paperID"])
-    ):  # IF referenced paper is already saved
-        # count occurence of paper up by 1
-        all_papers.loc[
-            all_papers["paperID"] == newPaper.loc[0, "paperID"], "occurence"
-        ] += 1
-    else:
-        # add referenced paper to all papers
-        all_papers = pd.concat([all_papers, newPaper], ignore_index=True)
+    # make room for the new relationships
+    end = number_of_relationships + len(codes)
+    if end > len(relationships):
+        relationships = np.resize(relationships, (max(2 * len(relationships), end), 2))
 
-    return all_papers, relationships
+    # add relationships between available and new papers
+    relationships[number_of_relationships:end, 0] = current_code
+    relationships[number_of_relationships:end, 1] = codes
+
+    return relationships, end
 
 
 def access_API(url):
@@ -102,10 +250,8 @@ def access_API(url):
 
     This function accesses the semantic scholar API via a given link and downloads the
     meta data of a respective paper. As the semantic scholar APi denies access if too
-    many downloads per 5 minute window were tried, the function gives the user a
-    feedback. The user can either wait or exit the download loop. If the user wants to
-    wait, the functions tries to download the meta information for several times after
-    a short time delay.
+    many downloads per 5 minute window were tried, the function tries to download the
+    meta information for several times with an exponentially growing time delay.
 
     Parameters
     ----------
@@ -115,32 +261,25 @@ def access_API(url):
 
     Returns
     -------
-     resp : dict
-        contains meta data of downloaded paper.
+     resp : requests.Response
+        contains meta data of downloaded paper. None if the server could not be
+        reached.
 
     """
     retries = 0
-    timeout = 5
     while retries < 10:
-        resp = requests.get(url)
+        try:
+            resp = requests.get(url, timeout=30)
+        except requests.RequestException as error:
+            # If the server could not be reached or did not answer in time.
+            print(f"Paper could not be downloaded: {error}")
+            return None
         if resp.status_code == 200:
             return resp
-        elif resp.status_code == 403 and retries == 0:
-            # Check if server does not allow download on the first try
-            user_input = input(
-                "You exceeded 100 requests per 5 minute window. "
-                "Do you want to wait (w) or exit (e)?: "
-            )
-            # if user wants to exit reading
-            if user_input == "e":
-                return None
-            else:
-                print(f"Sleeping for {timeout} seconds")
-                time.sleep(timeout)
-                retries += 1
-
         elif resp.status_code == 403:
-            print(f"Access denied. Sleeping for another {timeout} seconds")
+            # server does not allow download, wait and try again
+            timeout = 2**retries
+            print(f"Access denied. Sleeping for {timeout} seconds")
             time.sleep(timeout)
             retries += 1
         # If something else went wrong.
@@ -148,3 +287,72 @@ def access_API(url):
             print("Paper was not found in database")
             return resp
     return resp
+
+
+def fetch_all(dois, concurrency=8, cache_file=None, cache_expire=CACHE_EXPIRE):
+    """Download the meta data of several papers concurrently.
+
+    As downloading is bound by the network and not by the CPU, the requests to the
+    semantic scholar API are send in parallel by a pool of `concurrency` threads.
+    Successfully downloaded meta data is stored in a SQLite file keyed by DOI, so that
+    repeated runs only download papers which are not yet (or no longer) cached.
+
+    Parameters
+    ----------
+    dois : list
+        contains the DOIs of the papers to download
+    concurrency : int
+        maximum number of requests which are send at the same time
+    cache_file : str
+        path of the SQLite file caching the downloaded meta data. If None, nothing is
+        cached.
+    cache_expire : int
+        number of seconds after which a cached paper is downloaded again
+
+    Returns
+    -------
+    papers : list
+        contains the meta data of each paper as dict, in the same order as `dois`.
+        Papers which could not be downloaded are None.
+
+    """
+    papers = [None] * len(dois)
+    connection = sqlite3.connect(cache_file if cache_file else ":memory:")
+    with closing(connection):
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS papers "
+            "(doi TEXT PRIMARY KEY, json BLOB, fetched_at INTEGER)"
+        )
+
+        # get already downloaded papers from cache
+        missing = []
+        for idx, doi in enumerate(dois):
+            row = connection.execute(
+                "SELECT json FROM papers WHERE doi = ? AND fetched_at > ?",
+                (doi.lower(), int(time.time()) - cache_expire),
+            ).fetchone()
+            if row is None:
+                missing.append(idx)
+            else:
+                papers[idx] = orjson.loads(row[0])
+
+        # download missing papers and cache every paper as soon as it arrives,
+        # independently of the other downloads
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {
+                executor.submit(access_API, SEMANTIC_SCHOLAR_URL + dois[idx]): idx
+                for idx in missing
+            }
+            for future in as_completed(futures):
+                idx = futures[future]
+                resp = future.result()
+                if resp is None or resp.status_code != 200:
+                    continue
+                papers[idx] = orjson.loads(resp.content)
+                with connection:
+                    connection.execute(
+                        "INSERT OR REPLACE INTO papers VALUES (?, ?, ?)",
+                        (dois[idx].lower(), resp.content, int(time.time())),
+                    )
+
+    return papers